@@ -5,8 +5,9 @@ import matplotlib as mpl
 import matplotlib.gridspec as gridspec
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 import pandas as pd
-from scipy import stats
+from scipy.signal import fftconvolve
 from scipy.special import kl_div
+from concurrent.futures import ThreadPoolExecutor
 import random
 import config
 from utils import figure_utils
@@ -42,6 +43,9 @@ axes = []
 for i in range(cols):
     axes.append(fig.add_subplot(top_grid[i]))
 axbottom = fig.add_subplot(bottom_grid[1])
+for ax in axes + [axbottom]:
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
 
 # species = ['Bacteroides_vulgatus_57955', 'Alistipes_shahii_62199', 'Eubacterium_rectale_56927', 'Bacteroides_fragilis_54507']
 # species = ['Alistipes_shahii_62199']
@@ -54,44 +58,127 @@ def invert_bins(arr):
     end = arr[-1] + dx
     return np.arange(start, end, dx)
 
+
+def load_cached_txt(path):
+    # np.loadtxt is slow on the larger csv files, so keep a binary .npy copy of each one
+    # in the plotting intermediate directory (regenerated whenever the csv is newer than the copy).
+    # The copy is named after the csv and its directory, since e.g. the histogram and
+    # simulated transfer csvs of a species share the same file name
+    cache_path = os.path.join(config.plotting_intermediate_directory, "{}_{}.npy".format(
+        os.path.basename(os.path.dirname(os.path.abspath(path))), os.path.basename(path)))
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        return np.load(cache_path, mmap_mode='r')
+    arr = np.loadtxt(path)
+    np.save(cache_path, arr)
+    return arr
+
+
+def uniform_histogram(data, bins):
+    # same as np.histogram for evenly spaced bins:
+    # the bin of x is floor((x - bins[0]) / step), so no binary search over the edges is needed
+    data = np.asarray(data)
+    step = bins[1] - bins[0]
+    num_bins = len(bins) - 1
+    # as in np.histogram, the last bin includes its right edge and values outside the bins are dropped
+    data = data[(data >= bins[0]) & (data <= bins[-1])]
+    idxs = np.floor((data - bins[0]) / step).astype(np.int64)
+    np.clip(idxs, 0, num_bins - 1, out=idxs)
+    # rounding can put values on or next to an edge in a neighbouring bin,
+    # so check them against the actual edges (this is what np.histogram does for uniform bins too)
+    idxs[data < bins[idxs]] -= 1
+    idxs[(data >= bins[idxs + 1]) & (idxs != num_bins - 1)] += 1
+    return np.bincount(idxs, minlength=num_bins), bins
+
+
+def binned_ccdf(counts, bins, num_values):
+    # fraction of values >= each bin edge, straight from the histogram counts
+    # (values beyond the last bin still count towards the total)
+    return bins, 1 - np.cumsum(np.concatenate([[0], counts])) / float(num_values)
+
+
+def fft_kde(data, xs, bw_factor, num_grid=2048):
+    # same as stats.gaussian_kde(data, bw_method=bw_factor)(xs), but the data are first
+    # binned onto a fine grid and convolved with the gaussian kernel by FFT,
+    # instead of summing one gaussian per data point at every x
+    data = np.asarray(data)
+    bandwidth = bw_factor * np.std(data, ddof=1)
+    lo = min(data.min(), xs[0]) - 4 * bandwidth
+    hi = max(data.max(), xs[-1]) + 4 * bandwidth
+    grid, dx = np.linspace(lo, hi, num_grid, retstep=True)
+
+    # linear binning: split each point between its two neighbouring grid points
+    pos = (data - lo) / dx
+    left = np.minimum(np.floor(pos).astype(np.int64), num_grid - 2)
+    frac = pos - left
+    grid_counts = np.bincount(left, weights=1 - frac, minlength=num_grid)
+    grid_counts += np.bincount(left + 1, weights=frac, minlength=num_grid)
+
+    half_width = min(int(np.ceil(4 * bandwidth / dx)), num_grid - 1)
+    kernel = np.exp(-0.5 * (np.arange(-half_width, half_width + 1) * dx / bandwidth) ** 2)
+    density = fftconvolve(grid_counts, kernel, mode='same') / (len(data) * bandwidth * np.sqrt(2 * np.pi))
+    return np.interp(xs, grid, density)
+
+
+pretty_species_names = {}
+def get_pretty_species_name(species_name, manual=False):
+    # memoized figure_utils.get_pretty_species_name, since both panels label the same species
+    key = (species_name, manual)
+    if key not in pretty_species_names:
+        pretty_species_names[key] = figure_utils.get_pretty_species_name(species_name, manual=manual)
+    return pretty_species_names[key]
+
+
+def load_observed_transfers(species_name):
+    # divergences of the HMM inferred transfers in pairs passing the clonal fraction cutoff.
+    # Only two columns of the third_pass pickles are needed, so the filtered divergences are cached
+    # and the dataframes are only unpickled again when either pickle is newer than the cache
+    data_dir = os.path.join(config.analysis_directory, "closely_related")
+    save_path = os.path.join(data_dir, "third_pass", "{}_all_transfers.pickle".format(species_name))
+    raw_path = os.path.join(data_dir, 'third_pass', species_name + '.pickle')
+    cf_cutoff = config.clonal_fraction_cutoff
+    cache_file = os.path.join(config.plotting_intermediate_directory,
+                              "{}_observed_transfer_divergences_cf_{}.npy".format(species_name, cf_cutoff))
+    if os.path.exists(cache_file) and \
+            os.path.getmtime(cache_file) >= max(os.path.getmtime(save_path), os.path.getmtime(raw_path)):
+        return np.load(cache_file)
+
+    run_df = pd.read_pickle(save_path)
+    raw_df = pd.read_pickle(raw_path)
+
+    # filter on the underlying arrays rather than building intermediate dataframes
+    # (pairs are tuples, which np.isin would broadcast, so the lookup stays a hashed pandas isin)
+    good_pairs = raw_df['pairs'].values[raw_df['clonal fractions'].values > cf_cutoff]
+    mask = run_df['pairs'].isin(good_pairs).values
+    obs_transfers = run_df['synonymous divergences'].values[mask]
+    np.save(cache_file, obs_transfers)
+    return obs_transfers
+
 bottom_offset = 1e-3  # some bars are thinner than the bottom axis
 count = 0
-for i in range(cols):
-    # for j in range(3):
-    species_name = species_to_plot[i]
-    ax = axes[i]
+
+
+def prepare_species(species_name):
+    # loads and bins one species' transfers, without touching matplotlib,
+    # so that the species can be prepared in parallel before plotting
     # load simulated transfer distribution
-    histo = np.loadtxt(os.path.join(config.hmm_data_directory, species_name + '.csv'))
+    histo = file_futures[(species_name, 'histo')].result()
 
     # load HMM inferred transfer distribution
-    save_path = os.path.join(config.analysis_directory,
-                             "closely_related", "third_pass", "{}_all_transfers.pickle".format(species_name))
-    run_df = pd.read_pickle(save_path)
-    data_dir = os.path.join(config.analysis_directory, "closely_related")
-    raw_df = pd.read_pickle(os.path.join(data_dir, 'third_pass', species_name + '.pickle'))
+    obs_transfers = file_futures[(species_name, 'obs_transfers')].result()
 
-    cf_cutoff = config.clonal_fraction_cutoff
-    good_pairs = raw_df[raw_df['clonal fractions'] > cf_cutoff]['pairs']
-    mask = run_df['pairs'].isin(good_pairs)
-    full_df = run_df[mask]
-
-    # sim_transfers = np.loadtxt(os.path.join(
-    #     config.analysis_directory, 'closely_related', 'simulated_transfers', species_name+'.csv'))
-    sim_transfers = np.loadtxt(os.path.join(
-        config.analysis_directory, 'closely_related', 'simulated_transfers_cphmm', species_name+'.csv'))
-    sim_transfers = sim_transfers[~np.isnan(sim_transfers)]
-    obs_transfers = full_df['synonymous divergences']
+    sim_transfers = file_futures[(species_name, 'sim_transfers')].result()
+    # only copy when there actually are nans to drop
+    nan_mask = np.isnan(sim_transfers)
+    if np.count_nonzero(nan_mask) > 0:
+        sim_transfers = sim_transfers[~nan_mask]
 
     if 'vulgatus' in species_name:
         # vulgatus has 80 bins because we separated between and within clade transfer
         mids = histo[0, :40]
-        density = (histo[1, :40] + histo[1, 40:]) / np.sum(histo[1, :])
     else:
         mids = histo[0, :]
-        density = histo[1, :] / histo[1, :].sum()
 
     # simulated
-    # ax.bar(mids, density, width=mids[1] - mids[0], label='simulated', alpha=0.5)
     step = mids[1]-mids[0]
     step *= 2
 
@@ -99,36 +186,63 @@ for i in range(cols):
         max_bin = 0.2
     else:
         max_bin = max(sim_transfers.max(), obs_transfers.max())
+    # bins start at 0 and run to the largest transfer divergence of this species,
+    # so each species gets its own grid (there is no shared format to reuse one across species)
     bins = np.arange(0,  max_bin + step, step)
-    sim_hist = np.histogram(sim_transfers, bins=bins)
-    counts, bins = sim_hist
-    new_mids = (bins[:-1] + bins[1:]) / 2
-    sim_density = counts / np.sum(counts).astype(float)
-    # ax.bar(new_mids, sim_density, width=step, label='simulated', alpha=0.5)
-    _ = ax.hist(sim_transfers, density=True, bins=bins, alpha=0.3, color='tab:blue', label=None)
+    sim_counts, bins = uniform_histogram(sim_transfers, bins)
 
     # bins = invert_bins(histo[0, :])
-    counts, bins = np.histogram(obs_transfers, bins=bins)
-    new_mids = (bins[:-1] + bins[1:]) / 2
-    obs_density = counts / np.sum(counts).astype(float)
-    # ax.bar(new_mids, obs_density, width=step, label='observed', alpha=0.5)
-    _ = ax.hist(obs_transfers, density=True, bins=bins, alpha=0.3, color='tab:orange', label=None)
+    obs_counts, bins = uniform_histogram(obs_transfers, bins)
 
+    xs, sim_kde, obs_kde = None, None, None
     if plot_kde:
         kde_bw = 0.3
-        kde = stats.gaussian_kde(sim_transfers, bw_method=kde_bw)
+        # both kdes are evaluated on the same grid
         xs = np.linspace(0, bins.max(), 80)
-        ax.plot(xs, kde(xs), label='simulated')
+        sim_kde = fft_kde(sim_transfers, xs, kde_bw)
+        obs_kde = fft_kde(obs_transfers, xs, kde_bw)
 
-        kde = stats.gaussian_kde(obs_transfers, bw_method=kde_bw)
-        xs = np.linspace(0, bins.max(), 80)
-        ax.plot(xs, kde(xs), label='observed')
+    return sim_transfers, obs_transfers, bins, sim_counts, obs_counts, xs, sim_kde, obs_kde
+
+
+# start all the file reads up front on their own pool, so that they overlap with each other
+# and with the binning / kde work (which waits on them from a separate pool, so the two can't deadlock)
+io_executor = ThreadPoolExecutor(max_workers=3*cols)
+file_futures = {}
+for species_name in species_to_plot[:cols]:
+    file_futures[(species_name, 'histo')] = io_executor.submit(
+        load_cached_txt, os.path.join(config.hmm_data_directory, species_name + '.csv'))
+    # sim_transfers = np.loadtxt(os.path.join(
+    #     config.analysis_directory, 'closely_related', 'simulated_transfers', species_name+'.csv'))
+    file_futures[(species_name, 'sim_transfers')] = io_executor.submit(load_cached_txt, os.path.join(
+        config.analysis_directory, 'closely_related', 'simulated_transfers_cphmm', species_name+'.csv'))
+    file_futures[(species_name, 'obs_transfers')] = io_executor.submit(load_observed_transfers, species_name)
+ks_future = io_executor.submit(pd.read_csv, os.path.join(config.plotting_intermediate_directory, 'transfer_distribution_ks_test.csv'), index_col=0)
+io_executor.shutdown(wait=False)
+
+# the loads and binning are mostly I/O and numpy, so prepare all species on a thread pool;
+# matplotlib isn't thread safe, so the plotting below stays on the main thread
+with ThreadPoolExecutor(max_workers=cols) as executor:
+    species_data = list(executor.map(prepare_species, species_to_plot[:cols]))
+
+for i in range(cols):
+    # for j in range(3):
+    species_name = species_to_plot[i]
+    ax = axes[i]
+    sim_transfers, obs_transfers, bins, sim_counts, obs_counts, xs, sim_kde, obs_kde = species_data[i]
+
+    # weighting the bin edges by the counts draws the same bars without histogramming all the data again
+    _ = ax.hist(bins[:-1], weights=sim_counts, density=True, bins=bins, alpha=0.3, color='tab:blue', label=None)
+    _ = ax.hist(bins[:-1], weights=obs_counts, density=True, bins=bins, alpha=0.3, color='tab:orange', label=None)
+
+    if plot_kde:
+        ax.plot(xs, sim_kde, label='simulated')
+        ax.plot(xs, obs_kde, label='observed')
     # ax.legend()
     # ax.set_xlabel('transfer divergence')
-    ax.set_title(figure_utils.get_pretty_species_name(species_name))
+    ax.set_title(get_pretty_species_name(species_name))
+    ax.set_xlabel('transfer divergence (syn)')
     ax.set_ylim(bottom=-bottom_offset)
-    ax.spines['top'].set_visible(False)
-    ax.spines['right'].set_visible(False)
     ax.set_xlim(xmin=0)
 
     if 'vulgatus' in species_name:
@@ -143,12 +257,13 @@ for i in range(cols):
                               height="40%",
                               loc='upper right')
 
-        # inset_ax.hist(sim_transfers, cumulative=-1, density=True, bins=bins, alpha=0.5)
-        X, Y = figure_utils.plot_ecdf(inset_ax, sim_transfers, return_xy=True)
-        inset_ax.fill_between(X, Y, 0, color='tab:blue', alpha=.3, rasterized=True)
-        # inset_ax.hist(obs_transfers, cumulative=-1, density=True, bins=bins, alpha=0.5)
-        X, Y = figure_utils.plot_ecdf(inset_ax, obs_transfers, return_xy=True)
-        inset_ax.fill_between(X, Y, 0, color='tab:orange', alpha=.3, rasterized=True)
+        # complementary cdfs from the histogram counts above, rather than sorting all the transfers again
+        X, Y = binned_ccdf(sim_counts, bins, len(sim_transfers))
+        inset_ax.step(X, Y, where='post', rasterized=True)
+        inset_ax.fill_between(X, Y, 0, step='post', color='tab:blue', alpha=.3, rasterized=True)
+        X, Y = binned_ccdf(obs_counts, bins, len(obs_transfers))
+        inset_ax.step(X, Y, where='post', rasterized=True)
+        inset_ax.fill_between(X, Y, 0, step='post', color='tab:orange', alpha=.3, rasterized=True)
         inset_ax.set_xlim(xmin=0, xmax=inset_ax.get_xlim()[1] / 2)
         if 'rectale' in species_name:
             inset_ax.set_xlim(xmin=0, xmax=0.1)
@@ -156,7 +271,7 @@ for i in range(cols):
         inset_ax.set_yticks([0, 0.5, 1])
         inset_ax.set_yticklabels(['0', '0.5', '1'])
 
-ks_df = pd.read_csv(os.path.join(config.plotting_intermediate_directory, 'transfer_distribution_ks_test.csv'), index_col=0)
+ks_df = ks_future.result()
 ks_df.columns = ['Species name', 'ks stat', 'p val']
 ks_df.set_index('Species name', inplace=True)
 ks_df = ks_df.sort_values(by='ks stat', ascending=True)
@@ -167,9 +282,7 @@ axbottom.bar(xs[~significant_mask], ks_df['ks stat'][~significant_mask], linewid
 axbottom.set_xticks(xs)
 axbottom.set_xlim([-1, xs.max()+1])
 axbottom.set_ylabel('K-S distance ($D$)')
-axbottom.spines['top'].set_visible(False)
-axbottom.spines['right'].set_visible(False)
-species_names = map(lambda x: figure_utils.get_pretty_species_name(x, manual=True), ks_df.index.to_numpy())
+species_names = map(lambda x: get_pretty_species_name(x, manual=True), ks_df.index.to_numpy())
 for i in range(len(species_names)):
     if ks_df.index.to_numpy()[i] in species_to_plot:
         yloc = ks_df['ks stat'].iloc[i]
@@ -189,9 +302,6 @@ axbottom.add_artist(legend1)
 # axbottom.legend(ncol=2, loc='center left', bbox_to_anchor=(0.4, 0.9))
 axes[0].set_ylabel('probability density')
 # axes[-1].legend(loc=(1.1, 0.25))
-
-for j in range(cols):
-    axes[j].set_xlabel('transfer divergence (syn)')
 # axes[-2, -1].set_xlabel('transfer divergence (syn)')
 # axes[0, -1].legend(loc='upper right', bbox_to_anchor=(1.2, 0.9), fontsize=6)
 # axes[1, -1].legend(handles=[line], loc='upper right', bbox_to_anchor=(1.2, 0.9), fontsize=6)
@@ -1,5 +1,5 @@
+from __future__ import print_function
 from scipy.cluster.hierarchy import dendrogram, linkage
-from scipy.cluster.hierarchy import cophenet
 from scipy.cluster.hierarchy import fcluster
 from numpy.random import shuffle, normal
 
@@ -13,11 +13,8 @@ import numpy
 def cluster_samples(distance_matrix, min_d=0, max_ds=[1e09]):
  
     # calculate compressed distance matrix suitable for agglomerative clustering
-    Y = []
-    for i in xrange(0,distance_matrix.shape[0]):
-        for j in xrange(i+1,distance_matrix.shape[1]):
-            Y.append(distance_matrix[i,j]) 
-    Y = numpy.array(Y) 
+    # (upper triangle in row-major order)
+    Y = numpy.ascontiguousarray(distance_matrix[numpy.triu_indices(distance_matrix.shape[0],1)]) 
      
     Z = linkage(Y, method='average')        
     
@@ -54,18 +51,16 @@ def cluster_samples(distance_matrix, min_d=0, max_ds=[1e09]):
             cluster_idx_map[cluster_assignments[i]].append(i)
                 
         cluster_labels = set(cluster_idx_map.keys())
-        cluster_idxss = [set(cluster_idx_map[cluster_label]) for cluster_label in cluster_labels]
-        cluster_sizes = [len(cluster_idxs) for cluster_idxs in cluster_idxss]
      
         # only return ones with more than one individual
         final_clusters = []
         final_cluster_sizes = []
       
-        for cluster_idx_set in cluster_idxss:
+        for cluster_label in cluster_labels:
          
-            if len(cluster_idx_set)>1:
+            if len(cluster_idx_map[cluster_label])>1:
          
-                cluster_idxs = numpy.array([(i in cluster_idx_set) for i in xrange(0,len(cluster_assignments))])
+                cluster_idxs = (cluster_assignments==cluster_label)*coarse_grained_idxs
             
                 final_clusters.append(cluster_idxs)
                 final_cluster_sizes.append((cluster_idxs*1.0).sum())
@@ -102,11 +97,8 @@ def cluster_samples_within_clades(distance_matrix, clade_idxss=[], d=1e09):
         sub_distance_matrix = distance_matrix[numpy.ix_(numeric_clade_idxs, numeric_clade_idxs)]
  
         # calculate compressed distance matrix suitable for agglomerative clustering
-        Y = []
-        for i in xrange(0,sub_distance_matrix.shape[0]):
-            for j in xrange(i+1,sub_distance_matrix.shape[1]):
-                Y.append(sub_distance_matrix[i,j]) 
-        Y = numpy.array(Y) 
+        # (upper triangle in row-major order)
+        Y = numpy.ascontiguousarray(sub_distance_matrix[numpy.triu_indices(sub_distance_matrix.shape[0],1)]) 
      
         Z = linkage(Y, method='average')        
     
@@ -167,6 +159,16 @@ def calculate_phylogenetic_consistency(allele_counts_map, passed_sites_map, prop
     
     if len(clusters)>0: # Can only do stuff if there are clusters!
         
+        # clusters x samples membership matrix, so that the prevalences in 
+        # every cluster come from a single matrix product per gene
+        # (anticlusters are the complements, so theirs are population minus cluster)
+        cluster_matrix = numpy.array(clusters)*1.0
+        
+        # the same membership packed as bitsets (8 samples per byte), 
+        # and the number of set bits in each possible byte, 
+        # for the per-site permutations in the null below
+        cluster_bits = numpy.packbits(numpy.array(clusters), axis=1)
+        byte_popcounts = numpy.array([bin(byte).count('1') for byte in xrange(0,256)])
      
         for gene_name in allowed_genes:
          
@@ -192,48 +194,46 @@ def calculate_phylogenetic_consistency(allele_counts_map, passed_sites_map, prop
                 population_freqs = population_prevalence*1.0/(population_max_prevalence+10*(population_max_prevalence<0.5))
                 population_freqs = numpy.fmin(population_freqs, 1-population_freqs)
      
-                is_polymorphic = numpy.zeros(genotype_matrix.shape[0])
-                is_inconsistent = numpy.zeros(genotype_matrix.shape[0])
-     
-                for cluster_idxs,anticluster_idxs in zip(clusters,anticlusters):
-             
+                # clusters x sites prevalences, from one pass over the genotype matrix
+                cluster_prevalences = numpy.dot(cluster_matrix, (genotype_matrix*passed_sites_matrix).T)
+                cluster_passed_sites = numpy.dot(cluster_matrix, passed_sites_matrix.T)
                 
-                    cluster_prevalence = (genotype_matrix[:,cluster_idxs]*passed_sites_matrix[:,cluster_idxs]).sum(axis=1)
-                    cluster_min_prevalence = 1-1e-09
-                    cluster_max_prevalence = (passed_sites_matrix[:,cluster_idxs]).sum(axis=1)-1+1e-09
+                anticluster_prevalences = population_prevalence-cluster_prevalences
+                anticluster_passed_sites = population_max_prevalence-cluster_passed_sites
                 
-                    cluster_freqs = cluster_prevalence*1.0/(cluster_max_prevalence+10*(cluster_max_prevalence<0.5))
-                    cluster_freqs = numpy.fmin(cluster_freqs, 1-cluster_freqs)
-             
-                    anticluster_prevalence = (genotype_matrix[:,anticluster_idxs]*passed_sites_matrix[:,anticluster_idxs]).sum(axis=1)
-                    anticluster_min_prevalence = 1-1e-09
-                    anticluster_max_prevalence = (passed_sites_matrix[:,anticluster_idxs]).sum(axis=1) -1+1e-09
-             
-                    # Those that are polymorphic in the clade!
-                    polymorphic_sites = (cluster_prevalence>=cluster_min_prevalence)*(cluster_prevalence<=cluster_max_prevalence)
-                 
-                    # Those that are also polymorphic in the remaining population!
-                    inconsistent_sites = polymorphic_sites*(anticluster_prevalence>=anticluster_min_prevalence)*(anticluster_prevalence<=anticluster_max_prevalence)
-             
-                    is_polymorphic = numpy.logical_or(is_polymorphic, polymorphic_sites)
-                    is_inconsistent = numpy.logical_or(is_inconsistent, inconsistent_sites)
+                # prevalences are integers, so min_prevalence <= prevalence <= max_prevalence
+                # (with min 1 and max passed-1) just says both alleles are seen at least once.
+                # The four range checks per cluster then collapse to one minimum 
+                # and a single comparison for all clusters at once
+                cluster_min_prevalence = 1-1e-09
+                cluster_minor_prevalences = numpy.fmin(cluster_prevalences, cluster_passed_sites-cluster_prevalences)
+                anticluster_minor_prevalences = numpy.fmin(anticluster_prevalences, anticluster_passed_sites-anticluster_prevalences)
+                
+                # Those that are polymorphic in the clade!
+                polymorphic_sites = (cluster_minor_prevalences>=cluster_min_prevalence)
+                
+                # Those that are also polymorphic in the remaining population!
+                inconsistent_sites = (numpy.fmin(cluster_minor_prevalences, anticluster_minor_prevalences)>=cluster_min_prevalence)
+                
+                # in any of the clusters
+                is_polymorphic = polymorphic_sites.any(axis=0)
+                is_inconsistent = inconsistent_sites.any(axis=0)
             
-                if is_polymorphic.sum() > 0:
+                if numpy.count_nonzero(is_polymorphic) > 0:
             
                     is_singleton = (numpy.fabs(population_minor_prevalence-1)<1e-08)*is_polymorphic
                 
                     is_polymorphic = (population_minor_prevalence>1.5)*is_polymorphic
                 
                     singleton_freqs.extend( population_freqs[is_singleton] )
-                    singleton_variant_types[variant_type] += is_singleton.sum()
+                    singleton_variant_types[variant_type] += numpy.count_nonzero(is_singleton)
                 
                     polymorphic_freqs.extend( population_freqs[is_polymorphic] )
-                    polymorphic_variant_types[variant_type] += is_polymorphic.sum()
+                    polymorphic_variant_types[variant_type] += numpy.count_nonzero(is_polymorphic)
                 
-                    if is_inconsistent.sum() > 0:
-                        #inconsistent_freqs.extend( cluster_freqs[is_inconsistent] )
+                    if numpy.count_nonzero(is_inconsistent) > 0:
                         inconsistent_freqs.extend( population_freqs[is_inconsistent] )
-                        inconsistent_variant_types[variant_type] += is_inconsistent.sum()
+                        inconsistent_variant_types[variant_type] += numpy.count_nonzero(is_inconsistent)
                 
                     # now try to compute a null expectation for a completely unlinked genome
                     polymorphic_idxs = numpy.arange(0,genotype_matrix.shape[0])[is_polymorphic]
@@ -243,6 +243,10 @@ def calculate_phylogenetic_consistency(allele_counts_map, passed_sites_map, prop
                         genotypes = genotype_matrix[site_idx,:]
                         passed_sites = passed_sites_matrix[site_idx,:]
                         population_freq = population_freqs[site_idx]
+                        
+                        # totals don't change under permutation
+                        site_prevalence = population_prevalence[site_idx]
+                        site_max_prevalence = population_max_prevalence[site_idx]
                     
                         permuted_idxs = numpy.arange(0,len(genotypes))
                     
@@ -256,26 +260,26 @@ def calculate_phylogenetic_consistency(allele_counts_map, passed_sites_map, prop
                         
                             permuted_genotypes = genotypes[permuted_idxs]
                             permuted_passed_sites = passed_sites[permuted_idxs]
-                        
-                            # loop through clusters
-                            is_inconsistent = False
-                            for cluster_idxs,anticluster_idxs in zip(clusters,anticlusters):
-             
                             
-                                cluster_prevalence = (permuted_genotypes[cluster_idxs]*permuted_passed_sites[cluster_idxs]).sum()
-                                cluster_min_prevalence = 0.5
-                                cluster_max_prevalence = (permuted_passed_sites[cluster_idxs]).sum()-0.5
+                            # prevalences in all clusters at once: 
+                            # AND the packed samples with each cluster and count the set bits
+                            permuted_alt_bits = numpy.packbits(permuted_genotypes*permuted_passed_sites)
+                            permuted_passed_bits = numpy.packbits(permuted_passed_sites)
+                            
+                            cluster_prevalences = byte_popcounts[cluster_bits & permuted_alt_bits].sum(axis=1)
+                            cluster_min_prevalence = 0.5
+                            cluster_passed_sites = byte_popcounts[cluster_bits & permuted_passed_bits].sum(axis=1)
+                            cluster_max_prevalences = cluster_passed_sites-0.5
                 
-                    
-                                anticluster_prevalence = (permuted_genotypes[anticluster_idxs]*permuted_passed_sites[anticluster_idxs]).sum()
-                                anticluster_min_prevalence = 0.5
-                                anticluster_max_prevalence = (permuted_passed_sites[anticluster_idxs]).sum() - 0.5
+                            anticluster_prevalences = site_prevalence-cluster_prevalences
+                            anticluster_min_prevalence = 0.5
+                            anticluster_max_prevalences = site_max_prevalence-cluster_passed_sites-0.5
              
-                                polymorphic_in_cluster = ((cluster_prevalence>cluster_min_prevalence)*(cluster_prevalence<cluster_max_prevalence))
-                                inconsistent_in_cluster = (polymorphic_in_cluster*(anticluster_prevalence>anticluster_min_prevalence)*(anticluster_prevalence<anticluster_max_prevalence))
+                            polymorphic_in_clusters = ((cluster_prevalences>cluster_min_prevalence)*(cluster_prevalences<cluster_max_prevalences))
+                            inconsistent_in_clusters = (polymorphic_in_clusters*(anticluster_prevalences>anticluster_min_prevalence)*(anticluster_prevalences<anticluster_max_prevalences))
                             
-                                is_polymorphic = is_polymorphic or polymorphic_in_cluster
-                                is_inconsistent = is_inconsistent or inconsistent_in_cluster
+                            is_polymorphic = polymorphic_in_clusters.any()
+                            is_inconsistent = inconsistent_in_clusters.any()
                     
                         if is_inconsistent:
                             null_inconsistent_freqs.append(population_freq)
@@ -365,10 +369,10 @@ def load_manual_clade_divergence_threshold(species_name):
     divergence_threshold = 1e-02
     for line in file:
         items=line.split("\t")
-        print items[0].strip(), species_name
+        print(items[0].strip(), species_name)
         if items[0].strip()==species_name:
             divergence_threshold = float(items[1])
-            print "Setting divergence threshold!", divergence_threshold
+            print("Setting divergence threshold!", divergence_threshold)
             break
     file.close()
     return divergence_threshold
@@ -1,7 +1,8 @@
+from __future__ import print_function
 import numpy
 from scipy.linalg import eigh
+from scipy.linalg.blas import dsyrk
 from scipy.cluster.hierarchy import dendrogram, linkage
-from scipy.cluster.hierarchy import cophenet
 from scipy.cluster.hierarchy import fcluster
 from numpy.random import shuffle, normal
 import scipy.stats
@@ -9,6 +10,7 @@ from scipy.stats import binom
 import config
 from scipy.special import betainc
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from parsers import parse_midas_data
 import sample_utils
 import stats_utils
@@ -27,12 +29,26 @@ def calculate_consensus_genotypes(allele_counts_matrix,lower_threshold=0.2,upper
     freqs = allele_counts_matrix[:,:,0]*1.0/(depths+(depths==0))
     passed_sites_matrix = (depths>0)*numpy.logical_or(freqs<=lower_threshold,freqs>=upper_threshold)
     # consensus approximation
-    genotype_matrix = numpy.around(freqs)*passed_sites_matrix
+    # (genotypes are 0 or 1, so store them as int8 rather than float64)
+    genotype_matrix = (numpy.around(freqs)*passed_sites_matrix).astype(numpy.int8)
     
     
     return genotype_matrix, passed_sites_matrix
     
     
+# Calls consensus genotypes from matrix of allele counts,
+# without filtering on the within-sample allele frequency
+#
+# Returns: passed_sites matrix (depth>0), consensus freqs matrix (0 or 1)
+#
+def calculate_consensus_freqs(allele_counts_matrix):
+    
+    depths = allele_counts_matrix.sum(axis=2)
+    freqs = allele_counts_matrix[:,:,0]*1.0/(depths+(depths==0))
+    
+    return (depths>0), numpy.around(freqs)
+    
+    
 def calculate_consensus_polymorphic_genotypes(allele_counts_matrix,lower_threshold=0.2,upper_threshold=0.8):
     
     genotype_matrix, passed_sites_matrix =  calculate_consensus_genotypes(allele_counts_matrix,lower_threshold,upper_threshold) 
@@ -53,23 +69,27 @@ def calculate_consensus_polymorphic_genotypes(allele_counts_matrix,lower_thresho
 #
 def calculate_pca_coordinates(genotype_matrix, passed_sites_matrix):
 
-    Zl = (genotype_matrix*passed_sites_matrix).sum(axis=1)/(passed_sites_matrix).sum(axis=1)
+    Zl = (genotype_matrix*passed_sites_matrix).sum(axis=1)*1.0/(passed_sites_matrix).sum(axis=1)
 
     Zli = (genotype_matrix-Zl[:,None])*passed_sites_matrix
     
-    Mij = numpy.einsum('li,lj',Zli,Zli)/numpy.einsum('li,lj',passed_sites_matrix, passed_sites_matrix)
+    # samples x samples matrix products rather than einsum
+    Mij = numpy.dot(Zli.T,Zli)/numpy.dot(passed_sites_matrix.T, passed_sites_matrix)
 
     # calculate eigenvectors & eigenvalues of the covariance matrix
     # use 'eigh' rather than 'eig' since R is symmetric, 
     # the performance gain is substantial
-    evals, evecs = eigh(Mij)
+    # (and only ask for the top two, since those are all we use)
+    num_samples = Mij.shape[0]
+    evals, evecs = eigh(Mij, eigvals=(num_samples-2, num_samples-1))
 
     # sort eigenvalue in decreasing order
     idx = numpy.argsort(evals)[::-1]
     evals = evals[idx]
     evecs = evecs[:,idx]
     
-    variances = evals/evals.sum()
+    # sum of all eigenvalues = trace
+    variances = evals/Mij.trace()
     
     pca1_coords = evals[0]**0.5*evecs[:,0]
     pca2_coords = evals[1]**0.5*evecs[:,1]
@@ -78,6 +98,53 @@ def calculate_pca_coordinates(genotype_matrix, passed_sites_matrix):
     
  
 
+# Numerators (p_ab-p_a*p_b)^2 and denominators p_a*(1-p_a)*p_b*(1-p_b) of the LD
+# between each pair of sites (sites_2 x sites_1 matrices), from sites x samples
+# indicators for passed sites and for (alt allele AND passed) after the consensus approximation.
+# (shared by calculate_rsquared_condition_freq and calculate_sigmasquared, 
+#  which only differ in how they call consensus alleles and passed sites)
+def calculate_rsquared_moments(passed_sites_1, passed_freqs_1, passed_sites_2, passed_freqs_2):
+    
+    # sums over samples are written as matrix products (sites_2 x sites_1), 
+    # so we never build the sites x sites x samples joint_passed_sites matrix
+    
+    # this tells us what the denominator is for the computation below for joint_pooled_freqs
+    total_joint_passed_sites = numpy.dot(passed_sites_2, passed_sites_1.T).astype(numpy.float64)
+    # add 1 to denominator if some pair is 0. 
+    total_joint_passed_sites += (total_joint_passed_sites==0)
+    
+    # compute p_ab
+    # (divisions and masks below are done in place, so only one sites x sites buffer per quantity)
+    joint_pooled_freqs = numpy.dot(passed_freqs_2, passed_freqs_1.T).astype(numpy.float64)
+    joint_pooled_freqs /= total_joint_passed_sites
+    # floting point issue
+    joint_pooled_freqs *= (joint_pooled_freqs>1e-10)
+    
+    # compute p_a
+    marginal_pooled_freqs_1 = numpy.dot(passed_sites_2, passed_freqs_1.T).astype(numpy.float64)
+    marginal_pooled_freqs_1 /= total_joint_passed_sites
+    marginal_pooled_freqs_1 *= (marginal_pooled_freqs_1>1e-10)
+
+    # compute p_b
+    marginal_pooled_freqs_2 = numpy.dot(passed_freqs_2, passed_sites_1.T).astype(numpy.float64)
+    marginal_pooled_freqs_2 /= total_joint_passed_sites
+    marginal_pooled_freqs_2 *= (marginal_pooled_freqs_2>1e-10)
+       
+    # (p_ab-p_a*p_b)^2
+    rsquared_numerators = numpy.multiply(marginal_pooled_freqs_1, marginal_pooled_freqs_2)
+    numpy.subtract(joint_pooled_freqs, rsquared_numerators, out=rsquared_numerators)
+    numpy.square(rsquared_numerators, out=rsquared_numerators)
+    
+    # (p_a*(1-p_a)*pb*(1-p_b))
+    # built up in place; p_ab is no longer needed, so its buffer holds (1-p_b)
+    rsquared_denominators = numpy.subtract(1, marginal_pooled_freqs_1)
+    rsquared_denominators *= marginal_pooled_freqs_1
+    rsquared_denominators *= marginal_pooled_freqs_2
+    rsquared_denominators *= numpy.subtract(1, marginal_pooled_freqs_2, out=joint_pooled_freqs)
+    
+    return rsquared_numerators, rsquared_denominators
+    
+ 
 def calculate_rsquared_condition_freq(allele_counts_1, allele_counts_2, low_freq, high_freq):
     # Note: should actually be sigma_squared! 
     # sigma_squared= E[X]/E[Y], where X=(p_ab-pa*pb)^2 and Y=(pa*(1-pa)*pb*(1-pb))
@@ -86,15 +153,13 @@ def calculate_rsquared_condition_freq(allele_counts_1, allele_counts_2, low_freq
 
     # allele counts = 1 x samples x alleles vector
     
-    depths_1 = allele_counts_1.sum(axis=2)
-    freqs_1 = allele_counts_1[:,:,0]*1.0/(depths_1+(depths_1==0))
-    depths_2 = allele_counts_2.sum(axis=2)
-    freqs_2 = allele_counts_2[:,:,0]*1.0/(depths_2+(depths_2==0))
-
-    
     # consensus approximation
-    freqs_1 = numpy.around(freqs_1)
-    freqs_2 = numpy.around(freqs_2)
+    covered_sites_1, freqs_1 = calculate_consensus_freqs(allele_counts_1)
+    if allele_counts_2 is allele_counts_1:
+        # LD between sites of the same gene: no need to do it twice
+        covered_sites_2, freqs_2 = covered_sites_1, freqs_1
+    else:
+        covered_sites_2, freqs_2 = calculate_consensus_freqs(allele_counts_2)
 
     # condition on allele frequency in the pooled population:
     pooled_freqs_1=freqs_1[:,:].sum(axis=1)/len(freqs_1[0])
@@ -108,42 +173,18 @@ def calculate_rsquared_condition_freq(allele_counts_1, allele_counts_2, low_freq
     # None here takes the product of the elements in the two vectors and returns a matrix. 
 
     
-    passed_sites_1=(depths_1>0)*(pooled_freqs_1 >= low_freq)[:,None]*(pooled_freqs_1 <=high_freq)[:,None]
-    passed_sites_2=(depths_2>0)*(pooled_freqs_2 >= low_freq)[:,None]*(pooled_freqs_2 <= high_freq)[:,None]
-    joint_passed_sites=passed_sites_1[None,:,:]*passed_sites_2[:,None,:]
-    # sites x sites x samples matrix
-    
-    joint_freqs = freqs_1[None,:,:]*freqs_2[:,None,:]
-    # sites x sites x samples_matrix
-    
-    # this tells us what the denominator is for the computation below for joint_pooled_freqs
-    total_joint_passed_sites = joint_passed_sites.sum(axis=2)
-    # add 1 to denominator if some pair is 0. 
-    total_joint_passed_sites = total_joint_passed_sites+(total_joint_passed_sites==0)
-    
-    # compute p_ab
-    joint_pooled_freqs = (joint_freqs*joint_passed_sites).sum(axis=2)/total_joint_passed_sites   
-    # floting point issue
-    joint_pooled_freqs *= (joint_pooled_freqs>1e-10)
-    
-    # compute p_a
-    marginal_pooled_freqs_1 = (freqs_1[None,:,:]*joint_passed_sites).sum(axis=2)/total_joint_passed_sites
-    marginal_pooled_freqs_1 *= (marginal_pooled_freqs_1>1e-10)
-
-    # compute p_b
-    marginal_pooled_freqs_2 = (freqs_2[:,None,:]*joint_passed_sites).sum(axis=2)/total_joint_passed_sites 
-    marginal_pooled_freqs_2 *= (marginal_pooled_freqs_2>1e-10)
-       
-    # (p_ab-p_a*p_b)^2
-    rsquared_numerators = numpy.square(joint_pooled_freqs-marginal_pooled_freqs_1*marginal_pooled_freqs_2)
+    passed_sites_1=(covered_sites_1*(pooled_freqs_1 >= low_freq)[:,None]*(pooled_freqs_1 <=high_freq)[:,None]).astype(numpy.float32)
+    passed_sites_2=(covered_sites_2*(pooled_freqs_2 >= low_freq)[:,None]*(pooled_freqs_2 <= high_freq)[:,None]).astype(numpy.float32)
+    # sites x samples matrices
+    # (0s and 1s, so float32 is exact and the products below run as sgemm; 
+    # the counts they return are exact up to 2^24 samples and are cast back to float64)
     
-    # (p_a*(1-p_a)*pb*(1-p_b))
-    rsquared_denominators = marginal_pooled_freqs_1*(1-marginal_pooled_freqs_1)*marginal_pooled_freqs_2*(1-marginal_pooled_freqs_2)
-
-
-    rsquareds = rsquared_numerators/(rsquared_denominators+(rsquared_denominators==0))
+    # freqs are 0 or 1 after the consensus approximation, so these are
+    # indicators for (alt allele AND passed) and replace the old joint_freqs matrix
+    passed_freqs_1 = numpy.multiply(freqs_1, passed_sites_1, dtype=numpy.float32)
+    passed_freqs_2 = numpy.multiply(freqs_2, passed_sites_2, dtype=numpy.float32)
     
-    return rsquared_numerators, rsquared_denominators
+    return calculate_rsquared_moments(passed_sites_1, passed_freqs_1, passed_sites_2, passed_freqs_2)
 
 
 #####################################################################
@@ -160,43 +201,23 @@ def calculate_sigmasquared(allele_counts_1, allele_counts_2):
     # allele counts = 1 x samples x alleles vector
     
     freqs_1, passed_sites_1 = calculate_consensus_genotypes(allele_counts_1)
-    freqs_2, passed_sites_2 = calculate_consensus_genotypes(allele_counts_2)
-    
-    # this asks which pairs of sites have depths >0 at BOTH sites
-    # None here takes the product of the elements in the two vectors and returns a matrix. 
-    joint_passed_sites = (passed_sites_1)[None,:,:]*(passed_sites_2)[:,None,:]
-    # sites x sites x samples matrix
-    
-    joint_freqs = freqs_1[None,:,:]*freqs_2[:,None,:]
-    # sites x sites x samples_matrix
-    
-    # this tells us what the denominator is for the computation below for joint_pooled_freqs
-    total_joint_passed_sites = joint_passed_sites.sum(axis=2)
-    # add 1 to denominator if some pair is 0. 
-    total_joint_passed_sites = total_joint_passed_sites+(total_joint_passed_sites==0)
+    if allele_counts_2 is allele_counts_1:
+        # LD between sites of the same gene: no need to do it twice
+        freqs_2, passed_sites_2 = freqs_1, passed_sites_1
+    else:
+        freqs_2, passed_sites_2 = calculate_consensus_genotypes(allele_counts_2)
     
-    # compute p_ab
-    joint_pooled_freqs = (joint_freqs*joint_passed_sites).sum(axis=2)/total_joint_passed_sites   
-    # floting point issue
-    joint_pooled_freqs *= (joint_pooled_freqs>1e-10)
+    # sites x samples matrices of 0s and 1s
+    # (float32 is exact here and the products below run as sgemm; 
+    # the counts they return are exact up to 2^24 samples and are cast back to float64)
+    passed_sites_1 = passed_sites_1.astype(numpy.float32)
+    passed_sites_2 = passed_sites_2.astype(numpy.float32)
     
-    # compute p_a
-    marginal_pooled_freqs_1 = (freqs_1[None,:,:]*joint_passed_sites).sum(axis=2)/total_joint_passed_sites
-    marginal_pooled_freqs_1 *= (marginal_pooled_freqs_1>1e-10)
-
-    # compute p_b
-    marginal_pooled_freqs_2 = (freqs_2[:,None,:]*joint_passed_sites).sum(axis=2)/total_joint_passed_sites 
-    marginal_pooled_freqs_2 *= (marginal_pooled_freqs_2>1e-10)
-       
-    # (p_ab-p_a*p_b)^2
-    rsquared_numerators = numpy.square(joint_pooled_freqs-marginal_pooled_freqs_1*marginal_pooled_freqs_2)
-    
-    # (p_a*(1-p_a)*pb*(1-p_b))
-    rsquared_denominators = marginal_pooled_freqs_1*(1-marginal_pooled_freqs_1)*marginal_pooled_freqs_2*(1-marginal_pooled_freqs_2)
-    
-    rsquareds = rsquared_numerators/(rsquared_denominators+(rsquared_denominators==0))
+    # indicators for (alt allele AND passed)
+    passed_freqs_1 = freqs_1*passed_sites_1
+    passed_freqs_2 = freqs_2*passed_sites_2
     
-    return rsquared_numerators, rsquared_denominators
+    return calculate_rsquared_moments(passed_sites_1, passed_freqs_1, passed_sites_2, passed_freqs_2)
 
 
 #####################################################################
@@ -213,21 +234,37 @@ def calculate_unbiased_sigmasquared(allele_counts_1, allele_counts_2):
     # where we have corrected for finite sample effects
 
     genotypes_1, passed_sites_1 = calculate_consensus_genotypes(allele_counts_1)
-    genotypes_2, passed_sites_2 = calculate_consensus_genotypes(allele_counts_2)
+    if allele_counts_2 is allele_counts_1:
+        # LD between sites of the same gene: no need to do it twice
+        genotypes_2, passed_sites_2 = genotypes_1, passed_sites_1
+    else:
+        genotypes_2, passed_sites_2 = calculate_consensus_genotypes(allele_counts_2)
+    
     
+    # sites x samples matrices of 0s and 1s
+    # (float32 is exact here and the products below run as sgemm; 
+    # the counts they return are exact up to 2^24 samples and are cast back to float64)
+    passed_sites_1 = passed_sites_1.astype(numpy.float32)
+    passed_sites_2 = passed_sites_2.astype(numpy.float32)
     
     # this asks which pairs of sites have depths >0 at BOTH sites
-    # None here takes the product of the elements in the two vectors and returns a matrix. 
-    joint_passed_sites = (passed_sites_1)[None,:,:]*(passed_sites_2)[:,None,:]
-    # sites x sites x samples matrix
+    # sums over samples are written as matrix products (sites_2 x sites_1), 
+    # so we never build the sites x sites x samples joint_passed_sites matrix
+    
+    # indicators for (allele AND passed), each built once
+    # rather than as sites x sites x samples products of genotypes
+    alt_1 = genotypes_1*passed_sites_1
+    ref_1 = passed_sites_1-alt_1
+    alt_2 = genotypes_2*passed_sites_2
+    ref_2 = passed_sites_2-alt_2
     
     # allele counts
-    ns = joint_passed_sites.sum(axis=2)
+    ns = numpy.dot(passed_sites_2, passed_sites_1.T).astype(numpy.float64)
     
-    n11s = ((genotypes_1[None,:,:])*(genotypes_2[:,None,:])*joint_passed_sites).sum(axis=2)
-    n10s = (genotypes_1[None,:,:]*(1-genotypes_2[:,None,:])*joint_passed_sites).sum(axis=2)
-    n01s = ((1-genotypes_1[None,:,:])*(genotypes_2[:,None,:])*joint_passed_sites).sum(axis=2)
-    n00s = ((1-genotypes_1[None,:,:])*(1-genotypes_2[:,None,:])*joint_passed_sites).sum(axis=2)
+    n11s = numpy.dot(alt_2, alt_1.T).astype(numpy.float64)
+    n10s = numpy.dot(ref_2, alt_1.T).astype(numpy.float64)
+    n01s = numpy.dot(alt_2, ref_1.T).astype(numpy.float64)
+    n00s = numpy.dot(ref_2, ref_1.T).astype(numpy.float64)
     
     #print "Gene:" 
     #print n11s
@@ -319,42 +356,41 @@ def generate_haplotype(allele_counts_4D, allele_counts_1D, location_dictionary,
     
     locations=location_dictionary.keys()
     locations=sorted(locations)
+    
+    # annotation codes for (fixed diff from ref, polymorphic within host)
+    # 0 = no difference from ref, 1/2 = fixed syn/nonsyn diff from ref, 3/4 = polymorphic syn/nonsyn within host
+    annotation_codes = {'4D': (1,3), '1D': (2,4)}
+    
+    # build the per-sample strings for all sites at once
+    # if coverage ==0, then set to 'N' in both the consensus and annotation files. 
+    allele_strs={}
+    annotation_strs={}
+    for variant_type in ['4D','1D']:
+        fixed_code, polymorphic_code = annotation_codes[variant_type]
+        codes = numpy.where(freqs[variant_type]==0, 0, numpy.where(freqs[variant_type]==1, fixed_code, polymorphic_code))
+        no_coverage = (depths[variant_type]==0)
+        allele_strs[variant_type] = numpy.where(no_coverage, 'N', consensus[variant_type].astype(int).astype(str))
+        annotation_strs[variant_type] = numpy.where(no_coverage, 'N', codes.astype(str))
+    
+    num_samples = allele_counts_4D.shape[1]
+    consensus_matrix = numpy.empty((len(locations), num_samples+1), dtype=object)
+    annotation_matrix = numpy.empty((len(locations), num_samples+1), dtype=object)
+    
+    consensus_matrix[:,0] = annotation_matrix[:,0] = [str(int(location)) for location in locations]
+    for variant_type in ['4D','1D']:
+        rows = numpy.array([loc for loc in xrange(0,len(locations)) if location_dictionary[locations[loc]][1]==variant_type], dtype=int)
+        indices = numpy.array([location_dictionary[locations[loc]][0] for loc in rows], dtype=int)
+        consensus_matrix[rows,1:] = allele_strs[variant_type][indices]
+        annotation_matrix[rows,1:] = annotation_strs[variant_type][indices]
    
-    #s_consensus='' # store the haplotypes in a string for printing out later
-    #s_annotation=''
     outFile_consensus=open(os.path.expanduser('~/tmp_intermediate_files/tmp_consensus_%s.txt') % species_name ,'w')
     outFile_anno=open(os.path.expanduser('~/tmp_intermediate_files/tmp_anno_%s.txt') % species_name ,'w')
-
-    for loc in range(0, len(locations)):
-        location=str(int(locations[loc])) 
-        index=location_dictionary[locations[loc]][0]
-        variant_type=location_dictionary[locations[loc]][1]
-        alleles=consensus[variant_type][index].tolist()
-        annotation=freqs[variant_type][index].tolist()
-        coverage=depths[variant_type][index].tolist() # if coverage ==0, then set to 'N' in both the consensus and annotation files. 
-
-        for person in range(0, len(alleles)):
-            alleles[person]=str(int(alleles[person]))
-            if coverage[person] == 0.0:
-                alleles[person]='N'
-                annotation[person]='N'
-            else:
-                if annotation[person] ==0:
-                    annotation[person]=str(0) # no difference from ref
-                elif annotation[person] ==1:
-                    if variant_type=='4D':
-                        annotation[person]=str(1) # fixed syn diff from ref
-                    else:
-                        annotation[person]=str(2) # fixed nonsyn diff from ref
-                else: 
-                    if variant_type=='4D':
-                        annotation[person]=str(3) # polymorphic syn within host
-                    else:
-                        annotation[person]=str(4) # polymorphic nonsyn within host
-        s_consensus = location + ',' + ','.join(alleles) +'\n' 
-        s_annotation = location + ',' + ','.join(annotation) + '\n'
-        outFile_consensus.write(s_consensus)
-        outFile_anno.write(s_annotation)
+    
+    numpy.savetxt(outFile_consensus, consensus_matrix, fmt='%s', delimiter=',')
+    numpy.savetxt(outFile_anno, annotation_matrix, fmt='%s', delimiter=',')
+    
+    outFile_consensus.close()
+    outFile_anno.close()
 
 ####################################
 
@@ -378,12 +414,14 @@ def calculate_sample_freqs(allele_counts_map, passed_sites_map, variant_type='4D
         freqs = allele_counts[:,:,0]/(depths+(depths==0))
         if fold == True:
             freqs = numpy.fmin(freqs,1-freqs) #fold
+        # collect one array per gene and concatenate at the end
+        nonzero_freqs = (freqs>0)
         for sample_idx in xrange(0,freqs.shape[1]):
-            gene_freqs = freqs[:,sample_idx]
-            sample_freqs[sample_idx].extend( gene_freqs[gene_freqs>0])
+            sample_freqs[sample_idx].append( freqs[nonzero_freqs[:,sample_idx],sample_idx] )
             
         passed_sites += numpy.diagonal(passed_sites_map[gene_name][variant_type]['sites'])
         
+    sample_freqs = [numpy.concatenate(gene_freqs) if len(gene_freqs)>0 else numpy.array([]) for gene_freqs in sample_freqs]
     
     return sample_freqs, passed_sites
 
@@ -460,7 +498,7 @@ def calculate_temporal_sample_freqs(allele_counts_map, passed_sites_map, initial
             chromosomes.extend(chunk_chromosomes[marginal_passed_sites])
             positions.extend(chunk_positions[marginal_passed_sites])
         
-    print len(gene_names), len(chromosomes), len(initial_freqs), len(initial_depths)
+    print(len(gene_names), len(chromosomes), len(initial_freqs), len(initial_depths))
             
     return numpy.array(gene_names), numpy.array(chromosomes), numpy.array(positions), numpy.array(initial_freqs), numpy.array(final_freqs), numpy.array(marginal_initial_depths), numpy.array(marginal_final_depths)
 
@@ -546,6 +584,7 @@ def calculate_sample_freqs_2D(allele_counts_map, passed_sites_map, desired_sampl
     joint_passed_sites= [[] for i in xrange(0, num_samples)]
     passed_sites = numpy.zeros((num_samples, num_samples))*1.0
     
+    desired_idxs = numpy.flatnonzero(desired_samples)
 
     for gene_name in allowed_genes:
 
@@ -554,20 +593,23 @@ def calculate_sample_freqs_2D(allele_counts_map, passed_sites_map, desired_sampl
         if len(allele_counts)==0:
             continue
 
-        allele_counts = allele_counts[:,desired_samples,:]            
+        allele_counts = allele_counts[:,desired_idxs,:]            
         depths = allele_counts.sum(axis=2)
         freqs = allele_counts[:,:,0]*1.0/(depths+(depths==0))
-        joint_passed_sites_tmp=(depths>0)[:,None,:]*(depths>0)[:,:,None]
+        # sites with coverage in both the first sample and each other sample
+        joint_passed_sites_tmp=(depths>0)[:,0][:,None]*(depths>0)
 
         if fold== True:
             freqs = numpy.fmin(freqs,1-freqs) 
         
+        # collect one array per gene and concatenate at the end
         for sample_idx in xrange(0,freqs.shape[1]):
-            gene_freqs = freqs[:,sample_idx]
-            sample_freqs[sample_idx].extend(gene_freqs)
-            joint_passed_sites[sample_idx].extend(joint_passed_sites_tmp[:,0,sample_idx])
-            idx=numpy.where(desired_samples==True)
-        passed_sites += passed_sites_map[gene_name][variant_type]['sites'][:,idx[0]][idx[0],:]
+            sample_freqs[sample_idx].append(freqs[:,sample_idx])
+            joint_passed_sites[sample_idx].append(joint_passed_sites_tmp[:,sample_idx])
+        passed_sites += passed_sites_map[gene_name][variant_type]['sites'][numpy.ix_(desired_idxs,desired_idxs)]
+    
+    sample_freqs = [numpy.concatenate(gene_freqs) if len(gene_freqs)>0 else numpy.array([]) for gene_freqs in sample_freqs]
+    joint_passed_sites = [numpy.concatenate(gene_passed_sites) if len(gene_passed_sites)>0 else numpy.array([]) for gene_passed_sites in joint_passed_sites]
     
     return sample_freqs, passed_sites, joint_passed_sites
 
@@ -832,8 +874,86 @@ upper_threshold=config.consensus_upper_threshold):
     
     return doubleton_matrix, singleton_matrix, difference_matrix, opportunity_matrix
     
+# Returns num_matrices zeroed samples x samples accumulators. 
+# If out is given (e.g. the matrices returned by a previous call), 
+# these are zeroed and reused for the returned matrices.
+# (the arrays in out must be distinct, since each is accumulated separately)
+def get_zeroed_matrices(template_matrix, num_matrices, out=None):
+    
+    if out is None:
+        return [numpy.zeros(template_matrix.shape) for i in xrange(0,num_matrices)]
+        
+    for matrix in out:
+        matrix.fill(0)
+    return out
+
+# Returns gene_function(gene_name) for each gene in gene_names, in order.
+# The per-gene work below is mostly BLAS calls, which release the GIL, 
+# so with num_threads>1 genes are processed in parallel on a thread pool
+# (a few genes per thread at a time, so that only a handful of 
+#  per-gene samples x samples matrices are held in memory at once)
+def map_genes(gene_function, gene_names, num_threads=1):
+    
+    if num_threads <= 1:
+        for gene_name in gene_names:
+            yield gene_function(gene_name)
+        return
+    
+    gene_names = list(gene_names)
+    chunk_size = 4*num_threads
+    executor = ThreadPoolExecutor(max_workers=num_threads)
+    try:
+        for gene_idx in xrange(0,len(gene_names),chunk_size):
+            for result in executor.map(gene_function, gene_names[gene_idx:gene_idx+chunk_size]):
+                yield result
+    finally:
+        executor.shutdown()
+
+# Adds the matrices yielded by gene_function(gene_name) (e.g. one tuple per variant type, 
+# with None for matrices that are missing) into the matching matrices in totals. 
+# With num_threads>1 each gene's matrices are first summed on the thread pool 
+# (see map_genes), and only these per-gene sums are added into totals.
+def accumulate_gene_matrices(gene_function, gene_names, totals, num_threads=1):
+    
+    if num_threads <= 1:
+        for gene_name in gene_names:
+            for gene_matrices in gene_function(gene_name):
+                for total, matrix in zip(totals, gene_matrices):
+                    if matrix is not None:
+                        total += matrix
+        return totals
+    
+    def sum_gene_matrices(gene_name):
+        
+        gene_sums = [None for total in totals]
+        # the first matrix may be one of the caller's arrays (e.g. passed sites), 
+        # so it is only added into in place once we have made our own copy
+        owned = [False for total in totals]
+        
+        for gene_matrices in gene_function(gene_name):
+            for i, matrix in enumerate(gene_matrices):
+                if matrix is None:
+                    continue
+                if gene_sums[i] is None:
+                    gene_sums[i] = matrix
+                elif owned[i]:
+                    gene_sums[i] += matrix
+                else:
+                    gene_sums[i] = gene_sums[i]+matrix
+                    owned[i] = True
+        
+        return gene_sums
+    
+    for gene_sums in map_genes(sum_gene_matrices, gene_names, num_threads):
+        for total, gene_sum in zip(totals, gene_sums):
+            if gene_sum is not None:
+                total += gene_sum
+    
+    return totals
+    
+
 def calculate_mutation_reversion_matrix(allele_counts_map, passed_sites_map, allowed_variant_types=set([]), allowed_genes=set([]), lower_threshold=config.consensus_lower_threshold, 
-upper_threshold=config.consensus_upper_threshold, min_change=config.fixation_min_change):
+upper_threshold=config.consensus_upper_threshold, min_change=config.fixation_min_change, num_threads=1):
 
     total_genes = set(passed_sites_map.keys())
 
@@ -850,8 +970,10 @@ upper_threshold=config.consensus_upper_threshold, min_change=config.fixation_min
     
     mut_opportunity_matrix = numpy.zeros_like(mut_fixation_matrix)
     rev_opportunity_matrix = numpy.zeros_like(rev_fixation_matrix)
-              
-    for gene_name in allowed_genes:
+    
+    # mutations, reversions, mutation opportunities and reversion opportunities 
+    # for each variant type in one gene
+    def calculate_gene_matrices(gene_name):
         
         for variant_type in passed_sites_map[gene_name].keys():
              
@@ -873,46 +995,52 @@ upper_threshold=config.consensus_upper_threshold, min_change=config.fixation_min
             
             # Sites where the major allele is at sufficiently high frequency
             high_freq_sites = numpy.logical_or(ancestral_sites, derived_sites)
-            # Those where it is not
-            intermediate_freq_sites = numpy.logical_not(high_freq_sites)
             
-            # site*sample*sample matrix of sites with sufficient coverage in both samples
-            passed_depths = (depths>0)[:,:,None]*(depths>0)[:,None,:]
+            # site*sample matrix of sites with sufficient coverage
+            # (the sample*sample counts below are sums over sites of products of 
+            #  site*sample matrices, so we compute them as matrix products
+            #  rather than building site*sample*sample matrices)
+            passed_depths = (depths>0)*1.0
 
-            # site*sample*sample matrix of sites where we can look for differences            
-            confident_sites = numpy.logical_and(high_freq_sites[:,:,None], high_freq_sites[:,None,:])*passed_depths
+            # sites where we can look for differences (when paired with another confident site)
+            confident_sites = high_freq_sites*passed_depths
             
+            confident_ancestral_sites = ancestral_sites*passed_depths
+            confident_derived_sites = derived_sites*passed_depths
 
-            # site*sample*sample matrix of sites that are missing data 
+            # sample*sample matrix of sites that are missing data 
             # based on allele freqs, but which had sufficient coverage
             # (we need to remove these from opportunities below)
-            missing_data_sites = numpy.logical_or(intermediate_freq_sites[:,:,None],intermediate_freq_sites[:,None,:])*passed_depths
+            missing_data_sites = numpy.dot(passed_depths.T, passed_depths) - numpy.dot(confident_sites.T, confident_sites)
               
             # Calculate mutations and reversions
-            mutations = (ancestral_sites[:,:,None])*(derived_sites[:,None,:])*confident_sites
+            mutations = numpy.dot(confident_ancestral_sites.T, confident_derived_sites)
             
-            reversions = (derived_sites[:,:,None])*(ancestral_sites[:,None,:])*confident_sites
+            reversions = numpy.dot(confident_derived_sites.T, confident_ancestral_sites)
             
             # sites were you could have had a reversion
-            reversion_opportunities = derived_sites[:,:,None]*confident_sites
+            reversion_opportunities = numpy.dot(confident_derived_sites.T, confident_sites)
             
-            mut_fixation_matrix += (mutations).sum(axis=0)
-            rev_fixation_matrix += (reversions).sum(axis=0)
+            mut_opportunities = (passed_sites - missing_data_sites - reversion_opportunities ) 
             
-            rev_opportunity_matrix += (reversion_opportunities).sum(axis=0)
-            mut_opportunity_matrix += (passed_sites - missing_data_sites.sum(axis=0) - reversion_opportunities.sum(axis=0) ) 
+            yield mutations, reversions, mut_opportunities, reversion_opportunities
+              
+    accumulate_gene_matrices(calculate_gene_matrices, allowed_genes, [mut_fixation_matrix, rev_fixation_matrix, mut_opportunity_matrix, rev_opportunity_matrix], num_threads)
             
     return mut_fixation_matrix, rev_fixation_matrix, mut_opportunity_matrix, rev_opportunity_matrix    
     
 
 def calculate_fixation_matrix(allele_counts_map, passed_sites_map, allowed_variant_types=set([]), allowed_genes=set([]), lower_threshold=config.consensus_lower_threshold, 
-upper_threshold=config.consensus_upper_threshold, min_change=config.fixation_min_change):
+upper_threshold=config.consensus_upper_threshold, min_change=config.fixation_min_change, num_threads=1):
     
     mut_fixation_matrix, rev_fixation_matrix, mut_opportunity_matrix, rev_opportunity_matrix = calculate_mutation_reversion_matrix(allele_counts_map, passed_sites_map, allowed_variant_types, allowed_genes, lower_threshold, 
-upper_threshold, min_change)
+upper_threshold, min_change, num_threads)
 
-    fixation_matrix = mut_fixation_matrix + rev_fixation_matrix
-    opportunity_matrix = mut_opportunity_matrix + rev_opportunity_matrix
+    # the mutation matrices are only used here, so the sums go into them in place
+    fixation_matrix = mut_fixation_matrix
+    fixation_matrix += rev_fixation_matrix
+    opportunity_matrix = mut_opportunity_matrix
+    opportunity_matrix += rev_opportunity_matrix
     
     return fixation_matrix, opportunity_matrix
     
@@ -938,6 +1066,12 @@ upper_threshold=config.consensus_upper_threshold, min_change=config.fixation_min
      
     passed_sites = numpy.zeros_like(fixation_matrix_mutation)*1.0
     
+    # number of sites per block (~1MB of float64 site*sample*sample entries), 
+    # and a buffer for the frequency differences that is reused across blocks
+    num_samples = fixation_matrix_mutation.shape[0]
+    block_size = max(1, 131072//(num_samples*num_samples))
+    delta_freqs_buffer = numpy.empty((block_size, num_samples, num_samples))
+    
     for gene_name in allowed_genes:
         
         for variant_type in passed_sites_map[gene_name].keys():
@@ -955,20 +1089,31 @@ upper_threshold=config.consensus_upper_threshold, min_change=config.fixation_min
             freqs = allele_counts[:,:,0]*1.0/(depths+(depths==0))
             
             intermediate_freq_sites = (freqs>lower_threshold)*(freqs<upper_threshold)
+            
+            # loop over blocks of sites so that the site*sample*sample 
+            # matrices below stay small enough to fit in cache
+            num_sites = freqs.shape[0]
+            for site_idx in xrange(0, num_sites, block_size):
+                
+                block = slice(site_idx, site_idx+block_size)
+                block_freqs = freqs[block]
+                block_intermediate_freq_sites = intermediate_freq_sites[block]
    
-            passed_depths = (depths>0)[:,:,None]*(depths>0)[:,None,:]
+                passed_depths = (depths[block]>0)[:,:,None]*(depths[block]>0)[:,None,:]
             
-            bad_sites = numpy.logical_or(intermediate_freq_sites[:,:,None],intermediate_freq_sites[:,None,:])*passed_depths
+                bad_sites = numpy.logical_or(block_intermediate_freq_sites[:,:,None],block_intermediate_freq_sites[:,None,:])*passed_depths
             
-            delta_freqs = (freqs[:,:,None]-freqs[:,None,:])*passed_depths
+                delta_freqs = delta_freqs_buffer[0:block_freqs.shape[0]]
+                numpy.subtract(block_freqs[:,:,None], block_freqs[:,None,:], out=delta_freqs)
+                delta_freqs *= passed_depths
             
-            mutations = (delta_freqs>=min_change)
-            reversions = (delta_freqs<=(-1*min_change))
+                mutations = (delta_freqs>=min_change)
+                reversions = (delta_freqs<=(-1*min_change))
             
-            fixation_matrix_mutation += mutations.sum(axis=0) # sum over sites
-            fixation_matrix_reversion += reversions.sum(axis=0) # sum over sites
+                fixation_matrix_mutation += mutations.sum(axis=0) # sum over sites
+                fixation_matrix_reversion += reversions.sum(axis=0) # sum over sites
             
-            passed_sites -= bad_sites.sum(axis=0)
+                passed_sites -= bad_sites.sum(axis=0)
             
     return fixation_matrix_mutation, fixation_matrix_reversion, passed_sites  
 
@@ -1026,7 +1171,7 @@ def calculate_preexisting_snps(allele_counts_map, passed_sites_map, allowed_vari
 # in another. 
 #
 ####
-def calculate_new_snp_matrix(allele_counts_map, passed_sites_map, allowed_variant_types=set([]), allowed_genes=set([]), min_freq=0.05, max_freq=0.2):
+def calculate_new_snp_matrix(allele_counts_map, passed_sites_map, allowed_variant_types=set([]), allowed_genes=set([]), min_freq=0.05, max_freq=0.2, out=None, num_threads=1):
 
     total_genes = set(passed_sites_map.keys())
 
@@ -1038,20 +1183,22 @@ def calculate_new_snp_matrix(allele_counts_map, passed_sites_map, allowed_varian
     if len(allowed_variant_types)==0:
         allowed_variant_types = set(['1D','2D','3D','4D'])    
                     
-    new_snp_matrix = numpy.zeros_like(passed_sites_map.values()[0].values()[0]['sites'])*1.0  
-    passed_sites = numpy.zeros_like(new_snp_matrix)*1.0
+    new_snp_matrix, passed_sites = get_zeroed_matrices(passed_sites_map.values()[0].values()[0]['sites'], 2, out)
     
-    for gene_name in allowed_genes:
+    # new snps and passed sites for each variant type in one gene
+    # (new snps are None for variant types with no allele counts)
+    def calculate_gene_matrices(gene_name):
         
         for variant_type in passed_sites_map[gene_name].keys():
              
             if variant_type not in allowed_variant_types:
                 continue
         
-            passed_sites += passed_sites_map[gene_name][variant_type]['sites']
+            variant_passed_sites = passed_sites_map[gene_name][variant_type]['sites']
    
             allele_counts = allele_counts_map[gene_name][variant_type]['alleles']                        
             if len(allele_counts)==0:
+                yield None, variant_passed_sites
                 continue
             
 
@@ -1062,61 +1209,83 @@ def calculate_new_snp_matrix(allele_counts_map, passed_sites_map, allowed_varian
             
             # Turn
             
-            new_snps_1 = (mafs[:,:,None]<min_freq)*(mafs[:,None,:]>max_freq)
-            new_snps_2 = (mafs[:,:,None]>max_freq)*(mafs[:,None,:]<min_freq)
-            total_new_snps = new_snps_1+new_snps_2
-             
-            passed_depths = (depths>0)[:,:,None]*(depths>0)[:,None,:]
-    
-            total_new_snps[passed_depths==0] = 0
+            # sites with coverage that are below min_freq / above max_freq
+            # (sample*sample counts are sums over sites of products of these, 
+            #  so we compute them as matrix products)
+            passed_depths = (depths>0)
+            low_freq_sites = (mafs<min_freq)*passed_depths*1.0
+            high_freq_sites = (mafs>max_freq)*passed_depths*1.0
+            
+            # low in i and high in j; the reverse direction is just the transpose
+            new_snps = numpy.dot(low_freq_sites.T, high_freq_sites)
             
-            new_snp_matrix += total_new_snps.sum(axis=0)
+            yield new_snps+new_snps.T, variant_passed_sites
+    
+    accumulate_gene_matrices(calculate_gene_matrices, allowed_genes, [new_snp_matrix, passed_sites], num_threads)
         
     return new_snp_matrix, passed_sites  
 
 
    
-def calculate_pi_matrix(allele_counts_map, passed_sites_map, variant_type='4D', allowed_genes=None):
+def calculate_pi_matrix(allele_counts_map, passed_sites_map, variant_type='4D', allowed_genes=None, out=None, num_threads=1):
 
     if allowed_genes == None:
         allowed_genes = set(passed_sites_map.keys())
         
-    pi_matrix = numpy.zeros_like(passed_sites_map[passed_sites_map.keys()[0]][variant_type]['sites'])*1.0
-    avg_pi_matrix = numpy.zeros_like(pi_matrix)
-    passed_sites = numpy.zeros_like(pi_matrix)
+    pi_matrix, avg_pi_matrix, passed_sites = get_zeroed_matrices(passed_sites_map[passed_sites_map.keys()[0]][variant_type]['sites'], 3, out)
     
-    for gene_name in allowed_genes:
+    # passed sites, pi and avg pi in one gene
+    # (pi matrices are None for genes with no allele counts)
+    def calculate_gene_matrices(gene_name):
         
-        if gene_name in passed_sites_map.keys():
-            #print passed_sites_map[gene_name][variant_type].shape, passed_sites.shape
-            #print gene_name, variant_type
+        #print passed_sites_map[gene_name][variant_type].shape, passed_sites.shape
+        #print gene_name, variant_type
         
-            passed_sites += passed_sites_map[gene_name][variant_type]['sites']
-           
-            allele_counts = allele_counts_map[gene_name][variant_type]['alleles']
+        gene_passed_sites = passed_sites_map[gene_name][variant_type]['sites']
+       
+        allele_counts = allele_counts_map[gene_name][variant_type]['alleles']
 
-            if len(allele_counts)==0:
-                continue
+        if len(allele_counts)==0:
+            return gene_passed_sites, None, None
+     
+
+        depths = allele_counts.sum(axis=2)
+        freqs = allele_counts/(depths+(depths<0.1))[:,:,None]
+        self_freqs = (allele_counts-1)/(depths-1+2*(depths<1.1))[:,:,None]
+        self_pis = ((depths>0)-(freqs*self_freqs).sum(axis=2))
          
+        I,J = depths.shape
+        K = freqs.shape[2]
+        
+        passed_depths = (depths>0)*1.0
+        # (sites*alleles) x samples
+        flattened_freqs = freqs.transpose((0,2,1)).reshape((I*K,J))
 
-            depths = allele_counts.sum(axis=2)
-            freqs = allele_counts/(depths+(depths<0.1))[:,:,None]
-            self_freqs = (allele_counts-1)/(depths-1+2*(depths<1.1))[:,:,None]
-            self_pis = ((depths>0)-(freqs*self_freqs).sum(axis=2))
-             
-            I,J = depths.shape
-    
-            # pi between sample j and sample l
-            gene_pi_matrix = numpy.einsum('ij,il',(depths>0)*1.0,(depths>0)*1.0)-numpy.einsum('ijk,ilk',freqs,freqs)
-    
-            # average of pi within sample j and within sample i
-            gene_avg_pi_matrix = (numpy.einsum('ij,il',self_pis,(depths>0)*1.0)+numpy.einsum('ij,il',(depths>0)*1.0,self_pis))/2
+        # pi between sample j and sample l
+        # (symmetric, so syrk only computes the upper triangle; we then mirror it)
+        gene_pi_matrix = dsyrk(1.0,passed_depths,trans=1)-dsyrk(1.0,flattened_freqs,trans=1)
+        gene_pi_matrix = numpy.triu(gene_pi_matrix)+numpy.triu(gene_pi_matrix,1).T
+
+        # average of pi within sample j and within sample i
+        self_pi_matrix = numpy.dot(self_pis.T,passed_depths)
+        gene_avg_pi_matrix = (self_pi_matrix+self_pi_matrix.T)/2
+
+        diagonal_idxs = numpy.diag_indices(J)
+        gene_pi_matrix[diagonal_idxs] = gene_avg_pi_matrix[diagonal_idxs]
+
+        return gene_passed_sites, gene_pi_matrix, gene_avg_pi_matrix
     
-            diagonal_idxs = numpy.diag_indices(J)
-            gene_pi_matrix[diagonal_idxs] = gene_avg_pi_matrix[diagonal_idxs]
+    gene_names = [gene_name for gene_name in allowed_genes if gene_name in passed_sites_map]
     
-            pi_matrix += gene_pi_matrix
-            avg_pi_matrix += gene_avg_pi_matrix
+    for gene_passed_sites, gene_pi_matrix, gene_avg_pi_matrix in map_genes(calculate_gene_matrices, gene_names, num_threads):
+        
+        passed_sites += gene_passed_sites
+        
+        if gene_pi_matrix is None:
+            continue
+        
+        pi_matrix += gene_pi_matrix
+        avg_pi_matrix += gene_avg_pi_matrix
      
     # We used to normalize here    
     #pi_matrix = pi_matrix /(passed_sites+(passed_sites==0))
@@ -1173,14 +1342,21 @@ def estimate_sfs_downsampling(allele_counts, target_depth=10):
     # if you don't like it, send us an allele_counts matrix
     # that has been thresholded to a higher min value
     
-    count_density = numpy.zeros(Dmin+1)*1.0
-
+    Dmin = int(Dmin)
+    
+    # the downsampling probabilities only depend on (A,D), 
+    # so evaluate them once per distinct pair and weight by the number of sites
+    unique_counts, num_sites = numpy.unique(numpy.column_stack([allele_counts[:,0], depths]).astype(numpy.int64), axis=0, return_counts=True)
+    
+    A = unique_counts[:,0][:,None]
+    D = unique_counts[:,1][:,None]
+    ks = numpy.arange(0,Dmin+1)[None,:]
     
-    A = numpy.outer(allele_counts[:,0], numpy.ones(Dmin+1))
-    D = numpy.outer(depths, numpy.ones(Dmin+1))
-    ks = numpy.outer(numpy.ones_like(depths), numpy.arange(0,Dmin+1))
+    # lookup table with loggammas[n] = loggamma(n), so there are no loggamma calls per site
+    # loggammas[0] = inf, which zeros out impossible draws (ks>A or Dmin-ks>D-A) 
+    loggammas = loggamma(numpy.arange(0,D.max()+2))
     
-    count_density = numpy.exp(loggamma(A+1)-loggamma(A-ks+1)-loggamma(ks+1) + loggamma(D-A+1)-loggamma(D-A-(Dmin-ks)+1)-loggamma(Dmin-ks+1) + loggamma(D-Dmin+1) + loggamma(Dmin+1) - loggamma(D+1)).sum(axis=0)
+    count_density = (num_sites[:,None]*numpy.exp(loggammas[A+1]-loggammas[numpy.fmax(A-ks+1,0)]-loggammas[ks+1] + loggammas[D-A+1]-loggammas[numpy.fmax(D-A-(Dmin-ks)+1,0)]-loggammas[Dmin-ks+1] + loggammas[D-Dmin+1] + loggammas[Dmin+1] - loggammas[D+1])).sum(axis=0)
     
     return count_density
     
@@ -1219,23 +1395,33 @@ upper_threshold=config.consensus_upper_threshold, log10_depth_ratio_threshold=co
             allele_counts = allele_counts[:,[i,j],:]
             depths = allele_counts.sum(axis=2)
             alt_freqs = allele_counts[:,:,0]/(depths+(depths==0))
-    
-            safe_depths = depths+(depths==0)
             
-            log10_depth_ratios = numpy.fabs(numpy.log10((safe_depths[:,0]/avg_depth_i)/(safe_depths[:,1]/avg_depth_j)))
-                
-            passed_depths = (depths>0)[:,0]*(depths>0)[:,1]*(log10_depth_ratios<log10_depth_ratio_threshold)
-
-            mutations = (alt_freqs[:,0]<=lower_threshold)*(alt_freqs[:,1]>=upper_threshold)*passed_depths
-            reversions = (alt_freqs[:,0]>=upper_threshold)*(alt_freqs[:,1]<=lower_threshold)*passed_depths
+            # first find candidate changes from the frequencies alone
+            mutations = (alt_freqs[:,0]<=lower_threshold)&(alt_freqs[:,1]>=upper_threshold)
+            reversions = (alt_freqs[:,0]>=upper_threshold)&(alt_freqs[:,1]<=lower_threshold)
+            
+            candidate_sites = numpy.flatnonzero( (mutations|reversions)&(depths[:,0]>0)&(depths[:,1]>0) )
             
-            changed_sites = numpy.nonzero( numpy.logical_or(mutations, reversions) )[0]
+            # then only compute depth ratios for those
+            # (depths are >0 for candidates, so no need for safe_depths)
+            candidate_depths = depths[candidate_sites]
+            
+            log10_depth_ratios = numpy.fabs(numpy.log10((candidate_depths[:,0]/avg_depth_i)/(candidate_depths[:,1]/avg_depth_j)))
+            
+            changed_sites = candidate_sites[log10_depth_ratios<log10_depth_ratio_threshold]
             
             if len(changed_sites)>0:
                 # some fixations!
                 
-                for idx in changed_sites:
-                    snp_changes.append((gene_name, allele_counts_map[gene_name][variant_type]['locations'][idx], variant_type, (allele_counts[idx,0,0], depths[idx,0]), (allele_counts[idx,1,0],depths[idx,1]) ))
+                locations = allele_counts_map[gene_name][variant_type]['locations']
+                num_changes = len(changed_sites)
+                
+                # gather everything for the changed sites at once, then zip into tuples
+                changed_locations = [locations[idx] for idx in changed_sites]
+                initial_alleles = zip(allele_counts[changed_sites,0,0], depths[changed_sites,0])
+                final_alleles = zip(allele_counts[changed_sites,1,0], depths[changed_sites,1])
+                
+                snp_changes.extend( zip([gene_name]*num_changes, changed_locations, [variant_type]*num_changes, initial_alleles, final_alleles) )
                         
     return snp_changes
 
@@ -1558,7 +1744,7 @@ def calculate_smoothed_sfs(sfs_map, num_iterations=100, perr=0.01, lower_thresho
     #prefactors = numpy.exp( loggamma(Abars[None,:]+alts[:,None]+1)+loggamma(Rbars[None,:]+refs[:,None]+1)+loggamma(Dbar+1)+loggamma(depths+1)[:,None]-loggamma(Dbar+depths+2)[:,None]-loggamma(Abars+1)[None,:]-loggamma(Rbars+1)[None,:]-loggamma(alts+1)[:,None]-loggamma(refs+1)[:,None])
     #pfs = ((prefactors*(p_poly+(1-p_poly)*(betainc(Abars[None,:]+alts[:,None]+1, Rbars[None,:]+refs[:,None]+1, perr)+betainc(Rbars[None,:]+refs[:,None]+1, Abars[None,:]+alts[:,None]+1, perr))/(2*perr)))*weights[:,None]).sum(axis=0)
     
-    print p_poly, p_intermediate, Dbar
+    print(p_poly, p_intermediate, Dbar)
     
     return fs, pfs, p_intermediate, p_poly
     